@@ -1,17 +1,11 @@
-import json
+# the openff and vflib2 imports are deliberately deferred into the functions
+# below: pulling in the full OpenFF stack takes seconds, and --help or a bad
+# config shouldn't have to pay for it
 import logging
 from argparse import ArgumentParser
+from pathlib import Path
 
-from openff.qcsubmit.results import (
-    OptimizationResultCollection,
-    TorsionDriveResultCollection,
-)
-from openff.qcsubmit.utils import _CachedPortalClient, portal_client_manager
-from openff.toolkit import ForceField
-from vflib2.config import Config
-from vflib2.datasets import select_parameters
-from vflib2.forcebalance import generate
-from vflib2.msm import _main as msm_guess
+import orjson
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -24,7 +18,7 @@ OPT_SMIRKS = "opt-smirks.json"
 TD_SMIRKS = "td-smirks.json"
 
 
-def curate_data(ff, opt, td, ring_torsions):
+def curate_data(ff, opt, td, ring_torsions, n_processes=4):
     """Select the parameters in ``ff`` to train based on the datasets ``opt``
     and ``td.``
 
@@ -32,40 +26,79 @@ def curate_data(ff, opt, td, ring_torsions):
     parameter IDs, one per line, that correspond to in-ring torsions. Other
     in-ring torsions are usually filtered out of the training data.
 
+    ``n_processes`` is the size of the process pool used to label the
+    records.
+
+    Returns the selected opt and td smirks as dicts. Copies are also written
+    to ``OPT_SMIRKS`` and ``TD_SMIRKS`` for debugging.
+
     .. note::
        This function calls ``*ResultCollection.to_records`` internally, so you
        may want to wrap calls to it with a cached ``PortalClient`` via
        ``openff.qcsubmit.utils.portal_client_manager``.
     """
-    opt_smirks = select_parameters(opt, ["Bonds", "Angles"], ff)
-    with open(OPT_SMIRKS, "w") as f:
-        json.dump(opt_smirks, f, indent=2)
+    from vflib2.datasets import select_parameters
+
+    # materialize the records once per dataset so the cached client handles
+    # each fetch in bulk instead of paging per select_parameters pass
+    opt_records = list(opt.to_records())
+    opt_smirks = select_parameters(
+        opt_records, ["Bonds", "Angles"], ff, n_processes=n_processes
+    )
+    Path(OPT_SMIRKS).write_bytes(
+        orjson.dumps(opt_smirks, option=orjson.OPT_INDENT_2)
+    )
 
+    td_records = list(td.to_records())
     td_smirks = select_parameters(
-        td,
+        td_records,
         ["ProperTorsions", "ImproperTorsions"],
         ff,
         ring_torsions,
+        n_processes=n_processes,
+    )
+    Path(TD_SMIRKS).write_bytes(
+        orjson.dumps(td_smirks, option=orjson.OPT_INDENT_2)
     )
-    with open(TD_SMIRKS, "w") as f:
-        json.dump(td_smirks, f, indent=2)
+
+    return opt_smirks, td_smirks
 
 
 def main():
     args = parser.parse_args()
 
+    from openff.qcsubmit.results import (
+        OptimizationResultCollection,
+        TorsionDriveResultCollection,
+    )
+    from openff.qcsubmit.utils import (
+        _CachedPortalClient,
+        portal_client_manager,
+    )
+    from openff.toolkit import ForceField
+    from vflib2.config import Config
+    from vflib2.forcebalance import generate
+    from vflib2.msm import _main as msm_guess
+
     logger.info(f"loading config from {args.config}")
     conf = Config.from_yaml(args.config)
 
+    # decode the dataset JSON with orjson instead of parse_file, which goes
+    # through stdlib json internally. these files can be huge and mostly
+    # numbers, where orjson is several times faster
     assert len(conf.opt_datasets) == 1, "Only 1 opt dataset can be used"
     logger.info(f"loading opt data from {conf.opt_datasets[0]}")
-    opt = OptimizationResultCollection.parse_file(conf.opt_datasets[0])
+    opt = OptimizationResultCollection.parse_obj(
+        orjson.loads(Path(conf.opt_datasets[0]).read_bytes())
+    )
 
     logger.info(f"loaded {opt.n_results} opt records")
 
     assert len(conf.td_datasets) == 1, "Only 1 td dataset can be used"
     logger.info(f"loading td data from {conf.td_datasets[0]}")
-    td = TorsionDriveResultCollection.parse_file(conf.td_datasets[0])
+    td = TorsionDriveResultCollection.parse_obj(
+        orjson.loads(Path(conf.td_datasets[0]).read_bytes())
+    )
 
     logger.info(f"loaded {td.n_results} td records")
 
@@ -79,7 +112,7 @@ def main():
     )
 
     with portal_client_manager(lambda _: client):
-        curate_data(ff, opt, td, conf.ring_torsions)
+        opt_smirks, td_smirks = curate_data(ff, opt, td, conf.ring_torsions)
 
     # NOTE this modifies ff in place and also writes the result to msm.offxml
     if conf.do_msm:
@@ -97,8 +130,8 @@ def main():
             optimization_dataset=opt,
             torsion_dataset=td,
             forcefield=ffname,
-            valence_to_optimize=OPT_SMIRKS,
-            torsions_to_optimize=TD_SMIRKS,
+            valence_to_optimize=opt_smirks,
+            torsions_to_optimize=td_smirks,
             output_directory="output",
             smarts_to_exclude=conf.smarts_to_exclude,
             smiles_to_exclude=conf.smiles_to_exclude,
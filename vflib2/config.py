@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from pathlib import Path
 
 import yaml
 
@@ -15,6 +16,10 @@ class Config:
 
     @classmethod
     def from_yaml(cls, filename):
-        with open(filename) as f:
-            d = yaml.load(f, Loader=yaml.Loader)
-            return cls(**d)
+        # prefer the libyaml-backed C loader when PyYAML was built with it;
+        # the config only contains scalars and lists, so SafeLoader semantics
+        # are all we need. reading bytes up front also skips the buffered
+        # text-mode file object and lets the C parser do its own decoding
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        d = yaml.load(Path(filename).read_bytes(), Loader=loader)
+        return cls(**d)
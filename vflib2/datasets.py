@@ -1,14 +1,11 @@
 import functools
+import multiprocessing
 import typing
 from collections import Counter, defaultdict
+from pathlib import Path
 
 import numpy as np
-from openff.qcsubmit.results import (
-    OptimizationResultCollection,
-    TorsionDriveResultCollection,
-)
 from openff.toolkit import ForceField, Molecule
-from openff.toolkit.utils.exceptions import NotBondedError
 from qcportal.torsiondrive.record_models import (
     OptimizationRecord,
     TorsiondriveRecord,
@@ -17,36 +14,101 @@ from qcportal.torsiondrive.record_models import (
 Record = typing.Union[TorsiondriveRecord, OptimizationRecord]
 
 
-def safe_ring_bond(mol: Molecule, i: int, j: int) -> bool:
-    """Returns true if the bond between atoms ``i`` and ``j`` in ``mol`` is in
-    a ring. Catches ``NotBondedError``s and returns ``False`` instead.
+def _sorted_pair(i: int, j: int) -> typing.Tuple[int, int]:
+    return (i, j) if i < j else (j, i)
 
-    This function will always return ``False`` for improper torsions, but I
-    think an improper with three ring bonds will be fairly rare anyway.
 
-    """
-    try:
-        return mol.get_bond_between(i, j).is_in_ring()
-    except NotBondedError:
-        return False
+# process-local cache for ring_bond_set, keyed like _LABEL_CACHE below:
+# torsiondrive records of the same molecule share one ring perception pass
+_RING_BOND_CACHE: typing.Dict[
+    str, typing.FrozenSet[typing.Tuple[int, int]]
+] = {}
+
+
+def ring_bond_set(mol: Molecule) -> typing.FrozenSet[typing.Tuple[int, int]]:
+    """Return the in-ring bonds of ``mol`` as a set of sorted atom index
+    pairs, so callers can test many bonds with hash lookups.
+
+    The set is built from a single rdkit conversion; ``Bond.is_in_ring``
+    converts the whole molecule again for every bond it is asked about. The
+    result is cached on the molecule's mapped SMILES, which rdkit atom
+    indices follow."""
+    key = mol.to_smiles(mapped=True)
+    ring_bonds = _RING_BOND_CACHE.get(key)
+    if ring_bonds is None:
+        rdmol = mol.to_rdkit()
+        ring_bonds = _RING_BOND_CACHE[key] = frozenset(
+            _sorted_pair(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx())
+            for bond in rdmol.GetBonds()
+            if bond.IsInRing()
+        )
+    return ring_bonds
 
 
 def check_torsion_is_in_ring(
-    mol: Molecule,
+    ring_bonds: typing.FrozenSet[typing.Tuple[int, int]],
     indices: typing.Tuple[int, int, int, int],
 ) -> bool:
     """
     Check if a torsion is in a ring.
 
-    If a torsion I-J-K-L is given, it checks
-    whether all bonds I-J, J-K, and K-L are in a ring.
+    If a torsion I-J-K-L is given, it checks whether all bonds I-J, J-K, and
+    K-L are in ``ring_bonds``, as built by ``ring_bond_set``. Unbonded atom
+    pairs, as in improper torsions, are simply absent from the set.
 
     """
     i, j, k, m = indices
     return (
-        safe_ring_bond(mol, i, j)
-        and safe_ring_bond(mol, j, k)
-        and safe_ring_bond(mol, k, m)
+        _sorted_pair(i, j) in ring_bonds
+        and _sorted_pair(j, k) in ring_bonds
+        and _sorted_pair(k, m) in ring_bonds
+    )
+
+
+# process-local cache for force field labeling, keyed on the molecule's
+# mapped SMILES and the identity of the force field. many QC records share a
+# molecule (conformers, torsion grid points), so relabeling each record is
+# pure waste. a plain dict also works in multiprocessing workers since each
+# process keeps its own copy
+_LABEL_CACHE: typing.Dict[typing.Tuple[str, int], dict] = {}
+
+
+def label_molecule(molecule: Molecule, force_field: ForceField) -> dict:
+    """Return the ``force_field`` labels for ``molecule``, caching the result
+    on the molecule's mapped SMILES."""
+    key = (molecule.to_smiles(mapped=True), id(force_field))
+    labels = _LABEL_CACHE.get(key)
+    if labels is None:
+        labels = _LABEL_CACHE[key] = force_field.label_molecules(
+            molecule.to_topology()
+        )[0]
+    return labels
+
+
+# force field installed in each pool worker by _init_worker. building it once
+# per worker, instead of shipping it inside a functools.partial, keeps it from
+# being re-pickled with every chunk of records and gives it a stable id() for
+# the lifetime of the worker, which is what the _LABEL_CACHE key relies on
+_WORKER_FORCE_FIELD: typing.Optional[ForceField] = None
+
+
+def _init_worker(force_field_xml: str):
+    global _WORKER_FORCE_FIELD
+    _WORKER_FORCE_FIELD = ForceField(
+        force_field_xml, allow_cosmetic_attributes=True
+    )
+
+
+def _label_and_tag_ids_worker(
+    record_and_molecule: typing.Tuple[Record, Molecule],
+    parameter_types: typing.List[str],
+    ring_torsions: typing.FrozenSet[str],
+) -> typing.Set[typing.Tuple[str, str, str, int]]:
+    return label_and_tag_ids(
+        record_and_molecule,
+        _WORKER_FORCE_FIELD,
+        parameter_types,
+        ring_torsions,
     )
 
 
@@ -54,26 +116,36 @@ def label_and_tag_ids(
     record_and_molecule: typing.Tuple[Record, Molecule],
     force_field: ForceField,
     parameter_types: typing.List[str],
-    explicit_ring_torsions: typing.Optional[str] = None,
-) -> typing.Set[typing.Tuple[str, str, int]]:
-    if explicit_ring_torsions is not None:
-        ring_torsions = np.loadtxt(explicit_ring_torsions, dtype=str)
-    else:
-        ring_torsions = []
-
+    ring_torsions: typing.FrozenSet[str] = frozenset(),
+) -> typing.Set[typing.Tuple[str, str, str, int]]:
     record, molecule = record_and_molecule
-    mol_labels = force_field.label_molecules(molecule.to_topology())[0]
+    mol_labels = label_molecule(molecule, force_field)
     parameter_ids = set()
 
+    atomic_numbers = np.fromiter(
+        (atom.atomic_number for atom in molecule.atoms), dtype=np.uint8
+    )
+    n_heavy_atoms = int(np.count_nonzero(atomic_numbers != 1))
+
+    # precompute the central bond of the driven dihedral so the check in the
+    # inner loop is a pair of tuple compares instead of building two sets per
+    # labeled parameter
+    if isinstance(record, TorsiondriveRecord):
+        record_atoms = record.specification.keywords.dihedrals[0]
+        central_bond = (record_atoms[1], record_atoms[2])
+        # likewise, perceive rings once per molecule rather than three
+        # is_in_ring probes per candidate torsion
+        ring_bonds = ring_bond_set(molecule)
+
     for parameter_type in parameter_types:
         parameter_labels = mol_labels[parameter_type]
 
         for indices, parameter in parameter_labels.items():
             # remove mismatching torsiondrives
             if isinstance(record, TorsiondriveRecord):
-                # check central bond, i.e. middle 2 atoms
-                record_atoms = record.specification.keywords.dihedrals[0]
-                if set(indices[1:3]) != set(record_atoms[1:3]):
+                # check central bond, i.e. middle 2 atoms, in either order
+                i, j = indices[1], indices[2]
+                if (i, j) != central_bond and (j, i) != central_bond:
                     continue
 
                 # some general parameters overlap with in-ring torsions and
@@ -84,63 +156,106 @@ def label_and_tag_ids(
                 # noted that training on in-ring torsions is needed to
                 # properly model puckering in rings with hetero atoms
                 if parameter.id not in ring_torsions:
-                    if check_torsion_is_in_ring(molecule, indices):
+                    if check_torsion_is_in_ring(ring_bonds, indices):
                         continue
 
-            n_heavy_atoms = sum(
-                1 for atom in molecule.atoms if atom.atomic_number != 1
+            parameter_ids.add(
+                (parameter_type, parameter.id, record.id, n_heavy_atoms)
             )
-            parameter_ids.add((parameter.id, record.id, n_heavy_atoms))
     return parameter_ids
 
 
 def get_parameter_distribution(
-    dataset: typing.Union[
-        TorsionDriveResultCollection, OptimizationResultCollection
-    ],
+    records: typing.List[typing.Tuple[Record, Molecule]],
     parameter_types: typing.List[str],
     force_field: ForceField,
     explicit_ring_torsions: typing.Optional[str] = None,
     n_processes: int = 4,
 ) -> typing.Tuple[
-    Counter, typing.Dict[str, typing.List[typing.Tuple[int, str]]]
+    typing.Dict[str, Counter],
+    typing.Dict[str, typing.List[typing.Tuple[int, str]]],
 ]:
-    coverage = Counter()
+    """Count the labeled parameters in ``records``, which should be a
+    materialized list of ``*ResultCollection.to_records`` output. Taking the
+    records directly lets callers fetch them once, under a cached client, and
+    reuse the same list for multiple passes.
+
+    The returned coverage is grouped by parameter type so callers can match
+    parameter IDs to their handlers without probing every handler for every
+    ID."""
+    coverage = defaultdict(Counter)
     parameter_records = defaultdict(list)
 
+    # load the ring torsion IDs once up front rather than once per record,
+    # and as a frozenset so the membership check in label_and_tag_ids is O(1)
+    if explicit_ring_torsions is not None:
+        ring_torsions = frozenset(
+            Path(explicit_ring_torsions).read_text().split()
+        )
+    else:
+        ring_torsions = frozenset()
+
     func = functools.partial(
-        label_and_tag_ids,
-        force_field=force_field,
+        _label_and_tag_ids_worker,
         parameter_types=parameter_types,
-        explicit_ring_torsions=explicit_ring_torsions,
+        ring_torsions=ring_torsions,
     )
-    for record in dataset.to_records():
-        parameter_ids = func(record)
-        for parameter_id, record_id, n_heavy_atoms in parameter_ids:
-            coverage[parameter_id] += 1
-            parameter_records[parameter_id].append((n_heavy_atoms, record_id))
+    # labeling each record is CPU-bound and stateless, so spread the records
+    # over a process pool and aggregate the results back here. the force
+    # field is serialized once and rebuilt per worker by _init_worker rather
+    # than travelling with every task
+    with multiprocessing.Pool(
+        n_processes,
+        initializer=_init_worker,
+        initargs=(force_field.to_string(),),
+    ) as pool:
+        for parameter_ids in pool.imap_unordered(
+            func, records, chunksize=16
+        ):
+            for (
+                parameter_type,
+                parameter_id,
+                record_id,
+                n_heavy_atoms,
+            ) in parameter_ids:
+                coverage[parameter_type][parameter_id] += 1
+                parameter_records[parameter_id].append(
+                    (n_heavy_atoms, record_id)
+                )
 
-    return coverage, dict(parameter_records)
+    return dict(coverage), dict(parameter_records)
 
 
 def select_parameters(
-    dataset: typing.Union[
-        TorsionDriveResultCollection, OptimizationResultCollection
-    ],
+    records: typing.List[typing.Tuple[Record, Molecule]],
     parameter_types: typing.List[str],
     force_field: ForceField,
     explicit_ring_torsions: typing.Optional[str] = None,
-    n_processes: int = 1,
+    n_processes: int = 4,
     min_coverage: int = 5,
 ):
     coverage, _ = get_parameter_distribution(
-        dataset=dataset,
+        records=records,
         parameter_types=parameter_types,
         force_field=force_field,
         explicit_ring_torsions=explicit_ring_torsions,
         n_processes=n_processes,
     )
+    return select_from_coverage(
+        coverage, parameter_types, force_field, min_coverage
+    )
+
 
+def select_from_coverage(
+    coverage: typing.Dict[str, Counter],
+    parameter_types: typing.List[str],
+    force_field: ForceField,
+    min_coverage: int = 5,
+):
+    """Select the smirks of parameters in ``coverage`` with at least
+    ``min_coverage`` hits, restricted to ``parameter_types``. Splitting this
+    from ``select_parameters`` lets one ``get_parameter_distribution`` pass
+    over a dataset serve selections for multiple handler groups."""
     selected_parameters = defaultdict(list)
     for parameter_type in parameter_types:
         # make sure all the keys are present even if no data is found. this is
@@ -148,7 +263,7 @@ def select_parameters(
         if parameter_type not in selected_parameters:
             selected_parameters[parameter_type] = list()
         handler = force_field.get_parameter_handler(parameter_type)
-        for parameter_id, count in coverage.items():
+        for parameter_id, count in coverage.get(parameter_type, {}).items():
             if count < min_coverage:
                 continue
             parameters = handler.get_parameter({"id": parameter_id})
@@ -6,36 +6,47 @@ import os
 import typing
 from pathlib import Path
 
-from openff.bespokefit.optimizers.forcebalance import ForceBalanceInputFactory
-from openff.bespokefit.schema.fitting import (
-    OptimizationSchema,
-    OptimizationStageSchema,
-)
-from openff.bespokefit.schema.optimizers import ForceBalanceSchema
-from openff.bespokefit.schema.smirnoff import (
-    AngleHyperparameters,
-    AngleSMIRKS,
-    BondHyperparameters,
-    BondSMIRKS,
-    ImproperTorsionHyperparameters,
-    ImproperTorsionSMIRKS,
-    ProperTorsionHyperparameters,
-    ProperTorsionSMIRKS,
-)
-from openff.bespokefit.schema.targets import (
-    OptGeoTargetSchema,
-    TorsionProfileTargetSchema,
-)
+# the openff.bespokefit imports are deferred into generate; they pull in the
+# heaviest part of the import graph and only that one function needs them
 from openff.qcsubmit.results import (
     OptimizationResultCollection,
     TorsionDriveResultCollection,
 )
-from openff.qcsubmit.results.filters import SMARTSFilter, SMILESFilter
+from openff.qcsubmit.results.filters import (
+    CMILESResultFilter,
+    SMARTSFilter,
+    SMILESFilter,
+)
 from openff.toolkit import ForceField
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# linear angles only train k, not the equilibrium angle: a16, a17, a27, a35
+LINEAR_ANGLE_SMIRKS = frozenset(
+    [
+        "[*:1]~[#6X2:2]~[*:3]",  # a16
+        "[*:1]~[#7X2:2]~[*:3]",  # a17
+        "[*:1]~[#7X2:2]~[#7X1:3]",  # a27
+        # a35, this one anyways doesn't have a training target for ages
+        "[*:1]=[#16X2:2]=[*:3]",
+    ]
+)
+
+
+class CombinedExcludeFilter(CMILESResultFilter):
+    """Apply the SMARTS and SMILES exclusions in a single pass over a result
+    collection. Chaining the two filters in one ``.filter`` call still walks
+    and rebuilds the whole collection once per filter."""
+
+    smarts_filter: SMARTSFilter
+    smiles_filter: SMILESFilter
+
+    def _filter_function(self, result) -> bool:
+        return self.smarts_filter._filter_function(
+            result
+        ) and self.smiles_filter._filter_function(result)
+
 
 def load_training_data(
     optimization_dataset: OptimizationResultCollection,
@@ -44,25 +55,43 @@ def load_training_data(
     smiles_to_exclude: typing.Optional[str] = None,
     verbose: bool = False,
 ):
+    # strip, drop blank lines, and deduplicate so the filters below don't
+    # compile the same pattern twice
     if smarts_to_exclude is not None:
-        exclude_smarts = Path(smarts_to_exclude).read_text().splitlines()
+        exclude_smarts = sorted(
+            {
+                line.strip()
+                for line in Path(smarts_to_exclude).read_text().splitlines()
+                if line.strip()
+            }
+        )
     else:
         exclude_smarts = []
 
     if smiles_to_exclude is not None:
-        exclude_smiles = Path(smiles_to_exclude).read_text().splitlines()
+        exclude_smiles = sorted(
+            {
+                line.strip()
+                for line in Path(smiles_to_exclude).read_text().splitlines()
+                if line.strip()
+            }
+        )
     else:
         exclude_smiles = []
 
+    # build the filter once and share it between the two datasets so any
+    # internal pattern compilation is only paid for once
+    exclude_filter = CombinedExcludeFilter(
+        smarts_filter=SMARTSFilter(smarts_to_exclude=exclude_smarts),
+        smiles_filter=SMILESFilter(smiles_to_exclude=exclude_smiles),
+    )
+
     torsion_training_set = torsion_dataset
     if verbose:
         n = torsion_training_set.n_results
         logger.info(f"Loaded torsion training set with {n} entries.")
 
-    torsion_training_set = torsion_training_set.filter(
-        SMARTSFilter(smarts_to_exclude=exclude_smarts),
-        SMILESFilter(smiles_to_exclude=exclude_smiles),
-    )
+    torsion_training_set = torsion_training_set.filter(exclude_filter)
 
     if verbose:
         n = torsion_training_set.n_results
@@ -73,8 +102,7 @@ def load_training_data(
         n = optimization_training_set.n_results
         logger.info(f"Loaded optimization training set with {n} entries.")
     optimization_training_set = optimization_training_set.filter(
-        SMARTSFilter(smarts_to_exclude=exclude_smarts),
-        SMILESFilter(smiles_to_exclude=exclude_smiles),
+        exclude_filter
     )
     if verbose:
         n = optimization_training_set.n_results
@@ -88,8 +116,8 @@ def generate(
     optimization_dataset: OptimizationResultCollection,
     torsion_dataset: TorsionDriveResultCollection,
     forcefield: str,
-    valence_to_optimize: str,
-    torsions_to_optimize: str,
+    valence_to_optimize: typing.Union[dict, str],
+    torsions_to_optimize: typing.Union[dict, str],
     output_directory: str,
     smarts_to_exclude: typing.Optional[str] = None,
     smiles_to_exclude: typing.Optional[str] = None,
@@ -97,6 +125,28 @@ def generate(
     max_iterations: int = 50,
     port: int = 55387,
 ):
+    from openff.bespokefit.optimizers.forcebalance import (
+        ForceBalanceInputFactory,
+    )
+    from openff.bespokefit.schema.fitting import (
+        OptimizationSchema,
+        OptimizationStageSchema,
+    )
+    from openff.bespokefit.schema.optimizers import ForceBalanceSchema
+    from openff.bespokefit.schema.smirnoff import (
+        AngleHyperparameters,
+        AngleSMIRKS,
+        BondHyperparameters,
+        BondSMIRKS,
+        ImproperTorsionHyperparameters,
+        ImproperTorsionSMIRKS,
+        ProperTorsionHyperparameters,
+        ProperTorsionSMIRKS,
+    )
+    from openff.bespokefit.schema.targets import (
+        OptGeoTargetSchema,
+        TorsionProfileTargetSchema,
+    )
 
     torsion_training_set, optimization_training_set = load_training_data(
         optimization_dataset=optimization_dataset,
@@ -141,22 +191,22 @@ def generate(
         ),
     ]
 
-    # a16, a17, a27, a35
-    linear_angle_smirks = [
-        "[*:1]~[#6X2:2]~[*:3]",  # a16
-        "[*:1]~[#7X2:2]~[*:3]",  # a17
-        "[*:1]~[#7X2:2]~[#7X1:3]",  # a27
-        "[*:1]=[#16X2:2]=[*:3]",
-    ]  # a35, this one anyways doesn't have a training target for ages
-
-    with open(valence_to_optimize, "r") as f:
-        valence_smirks = json.load(f)
-    with open(torsions_to_optimize, "r") as f:
-        torsion_smirks = json.load(f)
+    # these can be passed directly as dicts from select_parameters or as
+    # paths to JSON files from a previous run
+    if isinstance(valence_to_optimize, dict):
+        valence_smirks = valence_to_optimize
+    else:
+        with open(valence_to_optimize, "r") as f:
+            valence_smirks = json.load(f)
+    if isinstance(torsions_to_optimize, dict):
+        torsion_smirks = torsions_to_optimize
+    else:
+        with open(torsions_to_optimize, "r") as f:
+            torsion_smirks = json.load(f)
 
     target_parameters = []
     for smirks in valence_smirks["Angles"]:
-        if smirks in linear_angle_smirks:
+        if smirks in LINEAR_ANGLE_SMIRKS:
             parameter = AngleSMIRKS(smirks=smirks, attributes={"k"})
         else:
             parameter = AngleSMIRKS(smirks=smirks, attributes={"k", "angle"})
@@ -175,20 +225,24 @@ def generate(
             "failed to deregister constraint handler, already unconstrained?"
         )
 
+    # index the handlers by smirks up front; both the membership test and the
+    # parameter lookup on a ParameterList are linear scans otherwise
     torsion_handler = ff.get_parameter_handler("ProperTorsions")
+    proper_by_smirks = {p.smirks: p for p in torsion_handler.parameters}
     for smirks in torsion_smirks["ProperTorsions"]:
-        if smirks in torsion_handler.parameters:
-            original_k = torsion_handler.parameters[smirks].k
-            attributes = {f"k{i + 1}" for i in range(len(original_k))}
+        parameter = proper_by_smirks.get(smirks)
+        if parameter is not None:
+            attributes = {f"k{i + 1}" for i in range(len(parameter.k))}
             target_parameters.append(
                 ProperTorsionSMIRKS(smirks=smirks, attributes=attributes)
             )
 
     improper_handler = ff.get_parameter_handler("ImproperTorsions")
+    improper_by_smirks = {p.smirks: p for p in improper_handler.parameters}
     for smirks in torsion_smirks["ImproperTorsions"]:
-        if smirks in improper_handler.parameters:
-            original_k = improper_handler.parameters[smirks].k
-            attributes = {f"k{i + 1}" for i in range(len(original_k))}
+        parameter = improper_by_smirks.get(smirks)
+        if parameter is not None:
+            attributes = {f"k{i + 1}" for i in range(len(parameter.k))}
             target_parameters.append(
                 ImproperTorsionSMIRKS(smirks=smirks, attributes=attributes)
             )
@@ -226,19 +280,11 @@ def generate(
 
     optfile = optdir / f"{optimization_schema.id}.json"
     with optfile.open("w") as f:
-        f.write(optimization_schema.json(indent=2))
+        f.write(optimization_schema.json())
 
-    ff = ForceField(
-        optimization_schema.initial_force_field,
-        allow_cosmetic_attributes=True,
-    )
-    try:
-        ff.deregister_parameter_handler("Constraints")
-    except KeyError:
-        logger.warn(
-            "failed to deregister constraint handler, already unconstrained?"
-        )
-    # Generate the ForceBalance inputs
+    # Generate the ForceBalance inputs, reusing the force field parsed above.
+    # it was loaded from the same file and already has the constraint handler
+    # deregistered, so there's no reason to pay for a second OFFXML parse
     ForceBalanceInputFactory.generate(
         os.path.join(optimization_schema.id),
         optimization_schema.stages[0],
@@ -1,63 +1,154 @@
+# the openff, qcportal, and qubekit imports are deferred into the functions
+# that need them (with annotations left unevaluated via __future__) so that
+# importing this module doesn't drag in the whole OpenFF stack
+from __future__ import annotations
+
+import copy
 import faulthandler
-import json
 import logging
+import multiprocessing
 import os
+import pickle
+import typing
 from collections import defaultdict
 
 import click
 import numpy as np
+import orjson
 import tqdm
-from openff.qcsubmit.results import (
-    BasicResultCollection,
-    OptimizationResultCollection,
-)
-from openff.qcsubmit.results.filters import LowestEnergyFilter
-from openff.toolkit import ForceField, Molecule
-from openff.units import unit
-from qcportal.singlepoint import SinglepointRecord
-from qubekit.molecules import Ligand
-from qubekit.bonded.mod_seminario import ModSeminario, ModSemMaths
+import zstandard as zstd
+
+if typing.TYPE_CHECKING:
+    from openff.qcsubmit.results import OptimizationResultCollection
+    from openff.toolkit import ForceField, Molecule
+    from openff.units import unit
+    from qcportal.singlepoint import SinglepointRecord
+    from qubekit.molecules import Ligand
 
 logging.getLogger("openff").setLevel(logging.ERROR)
 
+logger = logging.getLogger(__name__)
 
-# this doesn't make sense, but for some reason monkey patching this (to the
-# same function found in qubekit) has helped to avoid segfaults in the numpy
-# dot product here. I think more recent versions of numpy also avoid this issue
-def force_constant_bond(bond, eigenvals, eigenvecs, coords):
-    atom_a, atom_b = bond
-    eigenvals_ab = eigenvals[atom_a, atom_b, :]
-    eigenvecs_ab = eigenvecs[:, :, atom_a, atom_b]
+_QUBEKIT_PATCHED = False
 
-    unit_vectors_ab = ModSemMaths.unit_vector_along_bond(coords, bond)
 
-    return -0.5 * sum(
-        eigenvals_ab[i] * abs(np.dot(unit_vectors_ab, eigenvecs_ab[:, i]))
-        for i in range(3)
-    )
+def _patch_qubekit():
+    """Install the ``force_constant_bond`` monkey patch the first time
+    qubekit is actually needed.
 
+    This doesn't make sense, but for some reason monkey patching this (to the
+    same function found in qubekit) has helped to avoid segfaults in the
+    numpy dot product here. I think more recent versions of numpy also avoid
+    this issue.
+    """
+    global _QUBEKIT_PATCHED
+    if _QUBEKIT_PATCHED:
+        return
+    from qubekit.bonded.mod_seminario import ModSemMaths
 
-ModSemMaths.force_constant_bond = force_constant_bond
+    def force_constant_bond(bond, eigenvals, eigenvecs, coords):
+        atom_a, atom_b = bond
+        eigenvals_ab = eigenvals[atom_a, atom_b, :]
+        eigenvecs_ab = eigenvecs[:, :, atom_a, atom_b]
 
+        unit_vectors_ab = ModSemMaths.unit_vector_along_bond(coords, bond)
 
-def calculate_parameters(
-    qc_record: SinglepointRecord,
+        # project onto all three eigenvectors with a single matmul rather
+        # than three scalar np.dot calls in a Python-level sum
+        projections = np.abs(unit_vectors_ab @ eigenvecs_ab)
+        return -0.5 * float(eigenvals_ab @ projections)
+
+    ModSemMaths.force_constant_bond = force_constant_bond
+    _QUBEKIT_PATCHED = True
+
+
+def _write_zst(path: str, data: bytes):
+    """Write ``data`` to ``path`` with zstd compression."""
+    with open(path, "wb") as raw:
+        with zstd.ZstdCompressor().stream_writer(raw) as f:
+            f.write(data)
+
+
+def _read_zst(path: str) -> bytes:
+    """Read zstd-compressed bytes from ``path``."""
+    with open(path, "rb") as raw:
+        with zstd.ZstdDecompressor().stream_reader(raw) as f:
+            return f.read()
+
+
+def _prepare_molecule(
     molecule: Molecule,
     forcefield: ForceField,
-) -> dict[str, dict[str, list[unit.Quantity]]]:
-    """
-    Calculate the modified seminario parameters for the given input molecule
-    and store them by OFF SMIRKS.
-    """
-    mod_sem = ModSeminario()
+) -> tuple[Ligand, list, list]:
+    """Build the qubekit molecule and the (indices, smirks) pairs for the
+    labeled bonds and angles of ``molecule``, all of which are shared by
+    every hessian record of the same molecule."""
+    from qubekit.molecules import Ligand
+
+    from vflib2.datasets import label_molecule
+
+    _patch_qubekit()
 
     # create the qube molecule, this should be in the same order as the off_mol
     qube_mol = Ligand.from_rdkit(molecule.to_rdkit(), name="offmol")
-    qube_mol.hessian = qc_record.return_result
+    # label the openff molecule, through the process-local cache shared with
+    # datasets.py, so molecules appearing in both the curation and MSM steps
+    # (or across repeated calls) are only labeled once. flattening the labels
+    # here means the per-record loop below only walks plain tuples instead of
+    # repeating the dict iteration and parameter attribute access per hessian
+    labels = label_molecule(molecule, forcefield)
+    bond_smirks = [
+        (bond, parameter.smirks)
+        for bond, parameter in labels["Bonds"].items()
+    ]
+    angle_smirks = [
+        (angle, parameter.smirks)
+        for angle, parameter in labels["Angles"].items()
+    ]
+    return qube_mol, bond_smirks, angle_smirks
+
+
+def _coerce_hessian(return_result) -> np.ndarray:
+    """Coerce a record's hessian into a contiguous, square float64 array.
+
+    QCArchive can hand back nested lists or a flat array depending on how the
+    record was deserialized; converting once here means qubekit's
+    eigendecomposition runs on a contiguous buffer instead of silently
+    re-converting per call."""
+    hessian = np.ascontiguousarray(
+        np.asarray(return_result, dtype=np.float64)
+    )
+    if hessian.ndim != 2:
+        dim = int(round(np.sqrt(hessian.size)))
+        hessian = hessian.reshape(dim, dim)
+    return hessian
+
+
+def _apply_hessian(
+    qube_template: Ligand,
+    bond_smirks: list,
+    angle_smirks: list,
+    qc_record: SinglepointRecord,
+    molecule: Molecule,
+) -> dict[str, dict[str, list[unit.Quantity]]]:
+    """Run the modified Seminario method on a copy of ``qube_template`` with
+    the hessian from ``qc_record`` and collect the results by OFF SMIRKS.
+
+    ``molecule`` must carry the conformer the hessian was computed at; its
+    coordinates replace the template's, which were taken from whichever
+    record the template happened to be built from."""
+    from openff.units import unit
+    from qubekit.bonded.mod_seminario import ModSeminario
+
+    _patch_qubekit()
+
+    mod_sem = ModSeminario()
+
+    qube_mol = copy.deepcopy(qube_template)
+    qube_mol.coordinates = molecule.conformers[0].m_as(unit.angstrom)
+    qube_mol.hessian = _coerce_hessian(qc_record.return_result)
     # calculate the modified seminario parameters and store in the molecule
     qube_mol = mod_sem.run(qube_mol)
-    # label the openff molecule
-    labels = forcefield.label_molecules(molecule.to_topology())[0]
     # loop over all bonds and angles and collect the results in
     # nm/ kj/mol / radians(openMM units)
     all_parameters = {
@@ -67,20 +158,94 @@ def calculate_parameters(
         "angle_k": defaultdict(list),
     }
 
-    for bond, parameter in labels["Bonds"].items():
+    for bond, smirks in bond_smirks:
         # bond is a tuple of the atom index the parameter is applied to
         qube_param = qube_mol.BondForce[bond]
-        all_parameters["bond_eq"][parameter.smirks].append(qube_param.length)
-        all_parameters["bond_k"][parameter.smirks].append(qube_param.k)
+        all_parameters["bond_eq"][smirks].append(qube_param.length)
+        all_parameters["bond_k"][smirks].append(qube_param.k)
 
-    for angle, parameter in labels["Angles"].items():
+    for angle, smirks in angle_smirks:
         qube_param = qube_mol.AngleForce[angle]
-        all_parameters["angle_eq"][parameter.smirks].append(qube_param.angle)
-        all_parameters["angle_k"][parameter.smirks].append(qube_param.k)
+        all_parameters["angle_eq"][smirks].append(qube_param.angle)
+        all_parameters["angle_k"][smirks].append(qube_param.k)
 
     return all_parameters
 
 
+def calculate_parameters(
+    qc_record: SinglepointRecord,
+    molecule: Molecule,
+    forcefield: ForceField,
+) -> dict[str, dict[str, list[unit.Quantity]]]:
+    """
+    Calculate the modified seminario parameters for the given input molecule
+    and store them by OFF SMIRKS.
+    """
+    qube_template, bond_smirks, angle_smirks = _prepare_molecule(
+        molecule, forcefield
+    )
+    return _apply_hessian(
+        qube_template, bond_smirks, angle_smirks, qc_record, molecule
+    )
+
+
+# force field installed in each pool worker by _init_worker, mirroring the
+# initializer in datasets.py: rebuilding it once per worker instead of
+# pickling it with every group keeps its id() stable, which the label cache
+# in datasets.py keys on
+_WORKER_FORCE_FIELD: ForceField | None = None
+
+
+def _init_worker(force_field_xml: str):
+    global _WORKER_FORCE_FIELD
+    from openff.toolkit import ForceField
+
+    _WORKER_FORCE_FIELD = ForceField(
+        force_field_xml, allow_cosmetic_attributes=True
+    )
+
+
+def _calculate_group_parameters(
+    records_and_molecules: list[tuple[SinglepointRecord, Molecule]],
+):
+    """Pool worker that runs the modified Seminario method over a group of
+    records sharing a single molecule, preparing the qubekit molecule and
+    force field labels once for the whole group. The force field comes from
+    ``_init_worker``.
+
+    Returns the group's results pre-aggregated as flat (key, smirks, sum,
+    count) tuples, which pickle far more cheaply than nested defaultdicts of
+    lists, along with any (record, molecule) pairs that failed."""
+    molecule = records_and_molecules[0][1]
+    try:
+        qube_template, bond_smirks, angle_smirks = _prepare_molecule(
+            molecule, _WORKER_FORCE_FIELD
+        )
+    except Exception as e:
+        logger.warning(f"failed to prepare molecule: {e!r}")
+        return [], list(records_and_molecules)
+
+    sums = defaultdict(lambda: [0.0, 0])
+    errored = []
+    for record, molecule in records_and_molecules:
+        try:
+            parameters = _apply_hessian(
+                qube_template, bond_smirks, angle_smirks, record, molecule
+            )
+        except Exception as e:
+            logger.warning(f"record {record.id} errored: {e!r}")
+            errored.append((record, molecule))
+            continue
+        for key, values in parameters.items():
+            for smirks, value in values.items():
+                accumulator = sums[(key, smirks)]
+                accumulator[0] += sum(value)
+                accumulator[1] += len(value)
+    return [
+        (key, smirks, s, n) for (key, smirks), (s, n) in sums.items()
+    ], errored
+
+
 @click.command()
 @click.option(
     "--initial-force-field",
@@ -115,13 +280,32 @@ def calculate_parameters(
     default=False,
     help="Enable verbose logging.",
 )
+@click.option(
+    "--n-processes",
+    type=int,
+    default=4,
+    show_default=True,
+    help="The number of processes to use when calculating parameters.",
+)
+@click.option(
+    "--reuse-cache/--no-reuse-cache",
+    default=False,
+    help=(
+        "Reuse intermediate files from the working directory instead of "
+        "recomputing them."
+    ),
+)
 def main(
     initial_force_field: str,
     output_force_field: str,
     optimization_dataset: str,
     working_directory: str | None,
     verbose: bool = False,
+    n_processes: int = 4,
+    reuse_cache: bool = False,
 ):
+    from openff.qcsubmit.results import OptimizationResultCollection
+
     optimization_dataset = OptimizationResultCollection.parse_file(
         optimization_dataset
     )
@@ -131,6 +315,8 @@ def main(
         optimization_dataset,
         working_directory,
         verbose,
+        n_processes,
+        reuse_cache,
     )
 
 
@@ -140,10 +326,16 @@ def _main(
     dataset: OptimizationResultCollection,
     working_directory: str | None,
     verbose: bool = False,
+    n_processes: int = 4,
+    reuse_cache: bool = False,
 ):
     """Update the bond and angle parameters in ``ff`` using the modified
     Seminario method (MSM) and the Hessians in ``dataset``.
 
+    If ``reuse_cache`` is set and ``working_directory`` already holds a
+    ``hessian_set.json`` from a previous run, it is loaded directly instead
+    of re-filtering ``dataset`` against QCArchive.
+
     Note that the parameters are modified in place, but the resulting
     ``ForceField`` is also written to the file specified by
     ``output_force_field``.
@@ -154,58 +346,139 @@ def _main(
     idea to use a ``_CachedPortalClient`` with a ``portal_client_manager`` to
     prevent multiple requests to QCArchive.
     """
-    # filter for lowest energy results
-    print("filtering")
-    filtered = dataset.filter(LowestEnergyFilter())
-
-    # filter to only keep entries with hessians calculated
-    print("converting to results")
-    hessian_set = filtered.to_basic_result_collection(driver="hessian")
+    from openff.qcsubmit.results import BasicResultCollection
+    from openff.qcsubmit.results.filters import LowestEnergyFilter
+    from openff.units import unit
 
+    hessian_file = None
+    legacy_hessian_file = None
     if working_directory is not None:
-        if not os.path.exists(working_directory):
-            os.mkdir(working_directory)
-        hessian_file = os.path.join(working_directory, "hessian_set.json")
-        with open(hessian_file, "w") as f:
-            f.write(hessian_set.json(indent=2))
+        # the intermediate files are machine-read only, and QCSubmit JSON
+        # compresses very well, so store them zstd-compressed. the plain
+        # .json name is still accepted as a cache from older runs
+        hessian_file = os.path.join(
+            working_directory, "hessian_set.json.zst"
+        )
+        legacy_hessian_file = os.path.join(
+            working_directory, "hessian_set.json"
+        )
+
+    if (
+        reuse_cache
+        and hessian_file is not None
+        and os.path.exists(hessian_file)
+    ):
+        if verbose:
+            print(f"Loading cached hessian set from: {hessian_file}")
+        hessian_set = BasicResultCollection.parse_raw(
+            _read_zst(hessian_file)
+        )
+    elif (
+        reuse_cache
+        and legacy_hessian_file is not None
+        and os.path.exists(legacy_hessian_file)
+    ):
         if verbose:
-            print(f"Hessian set written to: {hessian_file}")
+            print(f"Loading cached hessian set from: {legacy_hessian_file}")
+        hessian_set = BasicResultCollection.parse_file(legacy_hessian_file)
+    else:
+        # filter for lowest energy results
+        print("filtering")
+        filtered = dataset.filter(LowestEnergyFilter())
+
+        # filter to only keep entries with hessians calculated
+        print("converting to results")
+        hessian_set = filtered.to_basic_result_collection(driver="hessian")
+
+        if working_directory is not None:
+            if not os.path.exists(working_directory):
+                os.mkdir(working_directory)
+            _write_zst(hessian_file, hessian_set.json().encode())
+            if verbose:
+                print(f"Hessian set written to: {hessian_file}")
 
     if verbose:
         print(f"Found {hessian_set.n_results} hessian calculations")
         print(f"Found {hessian_set.n_molecules} hessian molecules")
 
-    records_and_molecules = list(hessian_set.to_records())
-    if verbose:
-        records_and_molecules = tqdm.tqdm(
-            records_and_molecules,
-            desc="Calculating parameters",
-        )
+    # to_records is the other QCArchive round trip worth caching: even with a
+    # cached portal client the per-record deserialization is slow, and the
+    # materialized list pickles compactly
+    records_cache = None
+    if working_directory is not None:
+        records_cache = os.path.join(working_directory, "records.pkl.zst")
+
+    if (
+        reuse_cache
+        and records_cache is not None
+        and os.path.exists(records_cache)
+    ):
+        if verbose:
+            print(f"Loading cached records from: {records_cache}")
+        records_and_molecules = pickle.loads(_read_zst(records_cache))
+    else:
+        records_and_molecules = list(hessian_set.to_records())
+        if records_cache is not None:
+            _write_zst(records_cache, pickle.dumps(records_and_molecules))
+            if verbose:
+                print(f"Records written to: {records_cache}")
 
+    # accumulate running (sum, count) pairs per SMIRKS instead of whole value
+    # lists; only the means are needed below, and common SMIRKS would
+    # otherwise collect thousands of entries
     all_parameters = {
-        "bond_eq": defaultdict(list),
-        "bond_k": defaultdict(list),
-        "angle_eq": defaultdict(list),
-        "angle_k": defaultdict(list),
+        "bond_eq": defaultdict(lambda: [0.0, 0]),
+        "bond_k": defaultdict(lambda: [0.0, 0]),
+        "angle_eq": defaultdict(lambda: [0.0, 0]),
+        "angle_k": defaultdict(lambda: [0.0, 0]),
     }
     errored_records_and_molecules = []
+    # many hessian records share a molecule, so group by mapped SMILES and
+    # let each pool worker prepare the qubekit molecule and labels once per
+    # group instead of once per record
+    groups = defaultdict(list)
     for record, molecule in records_and_molecules:
-        try:
-            parameters = calculate_parameters(record, molecule, ff)
-        except BaseException:
-            errored_records_and_molecules.append((record, molecule))
-            continue
-        else:
-            for key, values in parameters.items():
-                for smirks, value in values.items():
-                    all_parameters[key][smirks].extend(value)
+        groups[molecule.to_smiles(mapped=True)].append((record, molecule))
+
+    with multiprocessing.Pool(
+        n_processes,
+        initializer=_init_worker,
+        initargs=(ff.to_string(),),
+    ) as pool:
+        results = pool.imap_unordered(
+            _calculate_group_parameters, groups.values()
+        )
+        if verbose:
+            results = tqdm.tqdm(
+                results,
+                total=len(groups),
+                desc="Calculating parameters",
+                mininterval=1.0,
+                smoothing=0.0,
+            )
+        for group_parameters, errored in results:
+            errored_records_and_molecules.extend(errored)
+            for key, smirks, s, n in group_parameters:
+                accumulator = all_parameters[key][smirks]
+                accumulator[0] += s
+                accumulator[1] += n
 
     if working_directory is not None:
         seminario_file = os.path.join(
-            working_directory, "seminario_parameters.json"
+            working_directory, "seminario_parameters.json.zst"
+        )
+        _write_zst(
+            seminario_file,
+            orjson.dumps(
+                {
+                    key: {
+                        smirks: {"sum": s, "count": n}
+                        for smirks, (s, n) in values.items()
+                    }
+                    for key, values in all_parameters.items()
+                }
+            ),
         )
-        with open(seminario_file, "w") as file:
-            json.dump(all_parameters, file, indent=2)
 
     if verbose:
         print(
@@ -213,7 +486,7 @@ def _main(
         )
     if working_directory is not None:
         if len(errored_records_and_molecules):
-            key = list(dataset.entries.keys())[0]
+            key = next(iter(dataset.entries))
             opt_records_by_id = {
                 record.record_id: record for record in hessian_set.entries[key]
             }
@@ -225,39 +498,49 @@ def _main(
                 entries={key: errored_records}
             )
             error_file = os.path.join(
-                working_directory, "errored_dataset.json"
+                working_directory, "errored_dataset.json.zst"
             )
-            with open(error_file, "w") as f:
-                f.write(errored_dataset.json(indent=2))
+            _write_zst(error_file, errored_dataset.json().encode())
             if verbose:
                 print(f"Errored dataset written to: {error_file}")
 
-    # now we need to update the FF parameters
-    kj_per_mol_per_nm2 = unit.kilojoule_per_mole / unit.nanometer**2
+    # now we need to update the FF parameters. precompute the target units
+    # and the linear conversion factors once instead of running a pint
+    # conversion per SMIRKS
+    kcal_per_mol_per_ang2 = unit.kilocalorie_per_mole / unit.angstrom**2
+    kcal_per_mol_per_rad2 = unit.kilocalorie_per_mole / unit.radian**2
+    nm_to_ang = (1.0 * unit.nanometer).m_as(unit.angstrom)
+    kj_nm2_to_kcal_ang2 = (
+        1.0 * unit.kilojoule_per_mole / unit.nanometer**2
+    ).m_as(kcal_per_mol_per_ang2)
+    rad_to_deg = (1.0 * unit.radian).m_as(unit.degree)
+    kj_to_kcal = (1.0 * unit.kilojoule_per_mole).m_as(
+        unit.kilocalorie_per_mole
+    )
+
+    # index the handlers by smirks once; handler.parameters[smirks] is a
+    # linear scan of the parameter list
     bond_handler = ff.get_parameter_handler("Bonds")
+    bond_by_smirks = {p.smirks: p for p in bond_handler.parameters}
     for smirks in all_parameters["bond_eq"]:
-        bond = bond_handler.parameters[smirks]
+        bond = bond_by_smirks[smirks]
 
-        bond_length = (
-            np.mean(all_parameters["bond_eq"][smirks]) * unit.nanometer
-        )
-        bond.length = bond_length.to(unit.angstrom)
+        s, n = all_parameters["bond_eq"][smirks]
+        bond.length = (s / n) * nm_to_ang * unit.angstrom
 
-        bond_k = np.mean(all_parameters["bond_k"][smirks]) * kj_per_mol_per_nm2
-        bond.k = bond_k.to(unit.kilocalorie_per_mole / (unit.angstrom**2))
+        s, n = all_parameters["bond_k"][smirks]
+        bond.k = (s / n) * kj_nm2_to_kcal_ang2 * kcal_per_mol_per_ang2
 
-    kj_per_mol_per_rad2 = unit.kilojoule_per_mole / (unit.radian**2)
     angle_handler = ff.get_parameter_handler("Angles")
+    angle_by_smirks = {p.smirks: p for p in angle_handler.parameters}
     for smirks in all_parameters["angle_eq"]:
-        angle = angle_handler.parameters[smirks]
+        angle = angle_by_smirks[smirks]
 
-        angle_eq = np.mean(all_parameters["angle_eq"][smirks]) * unit.radian
-        angle.angle = angle_eq.to(unit.degree)
+        s, n = all_parameters["angle_eq"][smirks]
+        angle.angle = (s / n) * rad_to_deg * unit.degree
 
-        angle_k = (
-            np.mean(all_parameters["angle_k"][smirks]) * kj_per_mol_per_rad2
-        )
-        angle.k = angle_k.to(unit.kilocalorie_per_mole / unit.radian**2)
+        s, n = all_parameters["angle_k"][smirks]
+        angle.k = (s / n) * kj_to_kcal * kcal_per_mol_per_rad2
 
     ff.to_file(output_force_field)
 